@@ -3,8 +3,9 @@ load_dotenv()
 import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
-import time
+from datetime import datetime
+import xxhash
+from streamlit_autorefresh import st_autorefresh
 from portfolio_manager import PortfolioManager
 from stock_data import StockDataManager
 from charts import ChartManager
@@ -22,14 +23,60 @@ st.set_page_config(
 def get_managers():
     portfolio_manager = PortfolioManager()
     stock_data_manager = StockDataManager()
-    chart_manager = ChartManager()
+    # Charts share the data manager so both read from the same caches
+    chart_manager = ChartManager(stock_data_manager)
     return portfolio_manager, stock_data_manager, chart_manager
 
 portfolio_manager, stock_data_manager, chart_manager = get_managers()
 
-# Initialize session state
+# Portfolio state keys: xxhash over a canonical repr is much cheaper than
+# Streamlit's default hasher, and these run on every rerun
+def state_hash(value):
+    return xxhash.xxh64(repr(value).encode()).hexdigest()
+
+def holdings_key(stocks_info):
+    return state_hash(sorted((symbol, info['shares']) for symbol, info in stocks_info.items()))
+
+# Cached chart builders: reruns with unchanged inputs skip both the data
+# fetch and the Plotly figure construction
+@st.cache_data(ttl=300, show_spinner=False)
+def get_stock_chart(symbol, period):
+    return chart_manager.create_stock_chart(symbol, period)
+
+@st.cache_data(ttl=300, show_spinner=False, hash_funcs={pd.DataFrame: lambda df: state_hash(df.values.tolist())})
+def get_portfolio_pie_chart(holdings_df):
+    return chart_manager.create_portfolio_pie_chart(holdings_df)
+
+def get_portfolio_history(portfolio_name, stocks_info):
+    # Past days of the 1-year history never change, so keep the series in the
+    # session and only recompute from its most recent day onward
+    holdings = holdings_key(stocks_info)
+    symbols = list(stocks_info.keys())
+    perf_cache = st.session_state.setdefault('perf_cache', {})
+    cached = perf_cache.get(portfolio_name)
+    
+    if cached is None or cached[0] != holdings:
+        values = chart_manager.calculate_portfolio_history(symbols, stocks_info)
+    else:
+        values = cached[1]
+        last_date = values.index[-1]
+        tail = chart_manager.calculate_portfolio_history(symbols, stocks_info, start=last_date.strftime('%Y-%m-%d'))
+        if tail is not None and not tail.empty:
+            values = pd.concat([values[values.index < last_date], tail])
+        values = values[values.index >= pd.Timestamp.now().normalize() - pd.DateOffset(years=1)]
+    
+    if values is None or values.empty:
+        perf_cache.pop(portfolio_name, None)
+        return None
+    
+    perf_cache[portfolio_name] = (holdings, values)
+    return values
+
+# Initialize session state; the manager is shared by all sessions, so each
+# new session loads its own portfolios
 if 'portfolios' not in st.session_state:
-    st.session_state.portfolios = {}
+    portfolio_manager.load_portfolios()
+    st.session_state.setdefault('portfolios', {})
 if 'current_portfolio' not in st.session_state:
     st.session_state.current_portfolio = None
 if 'last_refresh' not in st.session_state:
@@ -37,6 +84,7 @@ if 'last_refresh' not in st.session_state:
 
 def main():
     st.title("📈 Stock Portfolio Dashboard")
+    portfolio_manager.report_write_errors()
     
     # Show database connection status
     if hasattr(portfolio_manager, 'use_supabase') and portfolio_manager.use_supabase:
@@ -65,11 +113,7 @@ def main():
         st.subheader("Create New Portfolio")
         new_portfolio_name = st.text_input("Portfolio Name", key="new_portfolio")
         if st.button("Create Portfolio") and new_portfolio_name:
-            if new_portfolio_name not in st.session_state.portfolios:
-                st.session_state.portfolios[new_portfolio_name] = {
-                    'stocks': {},
-                    'created_date': datetime.now()
-                }
+            if portfolio_manager.create_portfolio(new_portfolio_name):
                 st.success(f"Portfolio '{new_portfolio_name}' created!")
                 st.rerun()
             else:
@@ -90,7 +134,7 @@ def main():
             # Delete portfolio
             if st.button("Delete Selected Portfolio", type="secondary"):
                 if len(st.session_state.portfolios) > 1:
-                    del st.session_state.portfolios[selected_portfolio]
+                    portfolio_manager.delete_portfolio(selected_portfolio)
                     st.session_state.current_portfolio = list(st.session_state.portfolios.keys())[0]
                     st.success(f"Portfolio '{selected_portfolio}' deleted!")
                     st.rerun()
@@ -100,6 +144,12 @@ def main():
         # Auto-refresh toggle
         st.subheader("Settings")
         auto_refresh = st.checkbox("Auto-refresh (30s)", value=False)
+        if auto_refresh:
+            # Browser-side timer; the script thread is free between refreshes
+            refresh_count = st_autorefresh(interval=30_000, key="auto_refresh")
+            if refresh_count != st.session_state.get('refresh_count'):
+                st.session_state.refresh_count = refresh_count
+                st.session_state.last_refresh = datetime.now()
         if st.button("Refresh Now"):
             st.session_state.last_refresh = datetime.now()
             st.rerun()
@@ -130,12 +180,7 @@ def main():
     
     with tab4:
         manage_stocks_interface(current_portfolio)
-    
-    # Auto-refresh logic
-    if auto_refresh:
-        time.sleep(30)
-        st.session_state.last_refresh = datetime.now()
-        st.rerun()
+
 
 def show_portfolio_overview(portfolio_name):
     st.header(f"Portfolio: {portfolio_name}")
@@ -149,40 +194,34 @@ def show_portfolio_overview(portfolio_name):
     
     # Get current prices for all stocks
     with st.spinner("Loading portfolio data..."):
-        portfolio_data = []
-        total_value = 0
-        total_cost = 0
+        prices = stock_data_manager.get_current_prices(list(stocks.keys()))
+        priced_symbols = [symbol for symbol in stocks if symbol in prices]
+        count = len(priced_symbols)
         
-        for symbol, stock_info in stocks.items():
-            try:
-                current_price = stock_data_manager.get_current_price(symbol)
-                if current_price is not None:
-                    shares = stock_info['shares']
-                    avg_price = stock_info['avg_price']
-                    current_value = current_price * shares
-                    cost_basis = avg_price * shares
-                    gain_loss = current_value - cost_basis
-                    gain_loss_pct = (gain_loss / cost_basis) * 100 if cost_basis > 0 else 0
-                    
-                    portfolio_data.append({
-                        'Symbol': symbol,
-                        'Shares': shares,
-                        'Avg Price': f"${avg_price:.2f}",
-                        'Current Price': f"${current_price:.2f}",
-                        'Current Value': f"${current_value:.2f}",
-                        'Cost Basis': f"${cost_basis:.2f}",
-                        'Gain/Loss': f"${gain_loss:.2f}",
-                        'Gain/Loss %': f"{gain_loss_pct:.2f}%",
-                        'gain_loss_raw': gain_loss,
-                        'current_value_raw': current_value
-                    })
-                    
-                    total_value += current_value
-                    total_cost += cost_basis
-            except Exception as e:
-                st.error(f"Error fetching data for {symbol}: {str(e)}")
+        # Compute every holding's figures in one set of array operations
+        shares = np.fromiter((stocks[symbol]['shares'] for symbol in priced_symbols), float, count)
+        avg_price = np.fromiter((stocks[symbol]['avg_price'] for symbol in priced_symbols), float, count)
+        current_price = np.fromiter((prices[symbol] for symbol in priced_symbols), float, count)
+        current_value = current_price * shares
+        cost_basis = avg_price * shares
+        gain_loss = current_value - cost_basis
+        gain_loss_pct = np.divide(gain_loss * 100, cost_basis, out=np.zeros(count), where=cost_basis > 0)
+        
+        # Build the holdings frame once; charts and the table read raw floats from it
+        df = pd.DataFrame({
+            'Symbol': priced_symbols,
+            'Shares': shares,
+            'Avg Price': avg_price,
+            'Current Price': current_price,
+            'Current Value': current_value,
+            'Cost Basis': cost_basis,
+            'Gain/Loss': gain_loss,
+            'Gain/Loss %': gain_loss_pct
+        })
+        total_value = float(current_value.sum())
+        total_cost = float(cost_basis.sum())
     
-    if portfolio_data:
+    if not df.empty:
         # Portfolio summary metrics
         total_gain_loss = total_value - total_cost
         total_gain_loss_pct = (total_gain_loss / total_cost) * 100 if total_cost > 0 else 0
@@ -196,30 +235,28 @@ def show_portfolio_overview(portfolio_name):
             st.metric("Total Gain/Loss", f"${total_gain_loss:.2f}", 
                      delta=f"{total_gain_loss_pct:.2f}%")
         with col4:
-            st.metric("Number of Stocks", len(portfolio_data))
+            st.metric("Number of Stocks", len(df))
         
         # Portfolio composition chart
         st.subheader("Portfolio Composition")
-        fig_pie = chart_manager.create_portfolio_pie_chart(portfolio_data)
-        st.plotly_chart(fig_pie, use_container_width=True)
+        fig_pie = get_portfolio_pie_chart(df)
+        st.plotly_chart(fig_pie, use_container_width=True, key=f"pie_chart_{portfolio_name}")
         
         # Portfolio performance table
         st.subheader("Holdings Details")
-        df = pd.DataFrame(portfolio_data)
         
-        # Color-code the gain/loss columns
-        def style_gain_loss(val):
-            if isinstance(val, str) and ('$' in val or '%' in val):
-                number = float(val.replace('$', '').replace('%', ''))
-                if number > 0:
-                    return 'color: green'
-                elif number < 0:
-                    return 'color: red'
-            return ''
+        # Color-code the gain/loss columns a whole column at a time
+        def style_gain_loss(column):
+            return np.select([column > 0, column < 0], ['color: green', 'color: red'], default='')
         
-        styled_df = df.drop(['gain_loss_raw', 'current_value_raw'], axis=1).style.map(
-            style_gain_loss, subset=['Gain/Loss', 'Gain/Loss %']
-        )
+        styled_df = df.style.format({
+            'Avg Price': '${:.2f}',
+            'Current Price': '${:.2f}',
+            'Current Value': '${:.2f}',
+            'Cost Basis': '${:.2f}',
+            'Gain/Loss': '${:.2f}',
+            'Gain/Loss %': '{:.2f}%'
+        }).apply(style_gain_loss, subset=['Gain/Loss', 'Gain/Loss %'])
         st.dataframe(styled_df, use_container_width=True)
         
         # Portfolio performance over time
@@ -227,8 +264,9 @@ def show_portfolio_overview(portfolio_name):
         symbols = list(stocks.keys())
         if symbols:
             try:
-                fig_portfolio = chart_manager.create_portfolio_performance_chart(symbols, stocks)
-                st.plotly_chart(fig_portfolio, use_container_width=True)
+                portfolio_values = get_portfolio_history(portfolio_name, stocks)
+                fig_portfolio = chart_manager.create_portfolio_performance_chart(symbols, stocks, portfolio_values)
+                st.plotly_chart(fig_portfolio, use_container_width=True, key=f"performance_chart_{portfolio_name}")
             except Exception as e:
                 st.error(f"Error creating portfolio performance chart: {str(e)}")
 
@@ -281,61 +319,54 @@ def show_individual_stocks(portfolio_name):
         
         # Stock chart
         try:
-            fig_stock = chart_manager.create_stock_chart(selected_stock, period)
-            st.plotly_chart(fig_stock, use_container_width=True)
+            fig_stock = get_stock_chart(selected_stock, period)
+            st.plotly_chart(fig_stock, use_container_width=True, key=f"stock_chart_{selected_stock}_{period}")
         except Exception as e:
             st.error(f"Error creating chart for {selected_stock}: {str(e)}")
 
+@st.fragment
 def add_stocks_interface(portfolio_name):
     st.header("Add Stocks to Portfolio")
     
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        # Stock search and add
+        # Stock search and add; the form only reruns on submit, not per keystroke
         st.subheader("Search and Add Stock")
-        stock_symbol = st.text_input("Stock Symbol (e.g., AAPL, MSFT)", key="add_stock_symbol").upper()
-        shares = st.number_input("Number of Shares", min_value=0.05, step=0.05, value=0.05, key="add_shares")
+        with st.form("add_stock_form"):
+            stock_symbol = st.text_input("Stock Symbol (e.g., AAPL, MSFT)", key="add_stock_symbol").upper()
+            shares = st.number_input("Number of Shares", min_value=0.05, step=0.05, value=0.05, key="add_shares")
+            avg_price = st.number_input("Average Purchase Price ($)", min_value=0.01, step=0.01, value=None,
+                                        placeholder="Current market price", key="add_avg_price")
+            
+            preview_col, add_col = st.columns(2)
+            with preview_col:
+                preview_clicked = st.form_submit_button("Preview")
+            with add_col:
+                add_clicked = st.form_submit_button("Add Stock")
         
-        # Get current market price for default average price
-        default_price = 0.01
-        if stock_symbol:
+        # Fetch the current price once per submit
+        current_price = None
+        if stock_symbol and (preview_clicked or add_clicked):
             try:
                 current_price = stock_data_manager.get_current_price(stock_symbol)
-                if current_price is not None:
-                    default_price = current_price
-            except:
-                pass
+            except Exception as e:
+                st.error(f"Error fetching price for {stock_symbol}: {str(e)}")
         
-        avg_price = st.number_input("Average Purchase Price ($)", min_value=0.01, step=0.01, value=default_price, key="add_avg_price")
+        # Default the average price to the current market price
+        if avg_price is None:
+            avg_price = current_price
         
-        if st.button("Add Stock") and stock_symbol and shares > 0 and avg_price > 0:
+        if add_clicked and stock_symbol and shares > 0:
             # Validate stock symbol
             try:
-                current_price = stock_data_manager.get_current_price(stock_symbol)
                 if current_price is not None:
-                    portfolio = st.session_state.portfolios[portfolio_name]
+                    existing = stock_symbol in st.session_state.portfolios[portfolio_name]['stocks']
+                    portfolio_manager.add_stock(portfolio_name, stock_symbol, shares, avg_price)
                     
-                    if stock_symbol in portfolio['stocks']:
-                        # Update existing position
-                        existing = portfolio['stocks'][stock_symbol]
-                        total_shares = existing['shares'] + shares
-                        total_cost = (existing['shares'] * existing['avg_price']) + (shares * avg_price)
-                        new_avg_price = total_cost / total_shares
-                        
-                        portfolio['stocks'][stock_symbol] = {
-                            'shares': total_shares,
-                            'avg_price': new_avg_price,
-                            'last_updated': datetime.now()
-                        }
+                    if existing:
                         st.success(f"Updated {stock_symbol} position!")
                     else:
-                        # Add new position
-                        portfolio['stocks'][stock_symbol] = {
-                            'shares': shares,
-                            'avg_price': avg_price,
-                            'last_updated': datetime.now()
-                        }
                         st.success(f"Added {stock_symbol} to portfolio!")
                     
                     st.rerun()
@@ -346,26 +377,23 @@ def add_stocks_interface(portfolio_name):
     
     with col2:
         # Stock preview
-        if stock_symbol:
+        if stock_symbol and preview_clicked:
             st.subheader(f"Preview: {stock_symbol}")
-            try:
-                current_price = stock_data_manager.get_current_price(stock_symbol)
-                if current_price is not None:
-                    st.metric("Current Price", f"${current_price:.2f}")
-                    if shares > 0:
-                        total_value = current_price * shares
-                        st.metric("Current Value", f"${total_value:.2f}")
-                    if avg_price > 0 and shares > 0:
-                        cost_basis = avg_price * shares
-                        gain_loss = (current_price - avg_price) * shares
-                        gain_loss_pct = ((current_price - avg_price) / avg_price) * 100
-                        st.metric("Estimated Gain/Loss", f"${gain_loss:.2f}", 
-                                 delta=f"{gain_loss_pct:.2f}%")
-                else:
-                    st.warning("Enter a valid stock symbol to see preview")
-            except Exception as e:
-                st.error(f"Error fetching preview: {str(e)}")
+            if current_price is not None:
+                st.metric("Current Price", f"${current_price:.2f}")
+                if shares > 0:
+                    total_value = current_price * shares
+                    st.metric("Current Value", f"${total_value:.2f}")
+                if avg_price > 0 and shares > 0:
+                    cost_basis = avg_price * shares
+                    gain_loss = (current_price - avg_price) * shares
+                    gain_loss_pct = ((current_price - avg_price) / avg_price) * 100
+                    st.metric("Estimated Gain/Loss", f"${gain_loss:.2f}", 
+                             delta=f"{gain_loss_pct:.2f}%")
+            else:
+                st.warning("Enter a valid stock symbol to see preview")
 
+@st.fragment
 def manage_stocks_interface(portfolio_name):
     st.header("Manage Stocks")
     
@@ -376,54 +404,36 @@ def manage_stocks_interface(portfolio_name):
         st.info("No stocks in this portfolio to manage.")
         return
     
-    # Stock management table
+    # Stock management table: one editable grid; edits only rerun this fragment
     st.subheader("Current Holdings")
     
-    for symbol, stock_info in stocks.items():
-        col1, col2, col3, col4, col5 = st.columns([2, 1, 1, 1, 1])
-        
-        with col1:
-            st.write(f"**{symbol}**")
-        
-        with col2:
-            # Edit shares
-            new_shares = st.number_input(
-                f"Shares", 
-                value=stock_info['shares'], 
-                min_value=0.05, 
-                step=0.05, 
-                key=f"shares_{symbol}"
-            )
-        
-        with col3:
-            # Edit average price
-            new_avg_price = st.number_input(
-                f"Avg Price", 
-                value=stock_info['avg_price'], 
-                min_value=0.01, 
-                step=0.01, 
-                key=f"avg_price_{symbol}"
-            )
-        
-        with col4:
-            # Update button
-            if st.button(f"Update", key=f"update_{symbol}"):
-                portfolio['stocks'][symbol] = {
-                    'shares': new_shares,
-                    'avg_price': new_avg_price,
-                    'last_updated': datetime.now()
-                }
-                st.success(f"Updated {symbol}!")
-                st.rerun()
-        
-        with col5:
-            # Remove button
-            if st.button(f"Remove", key=f"remove_{symbol}", type="secondary"):
-                del portfolio['stocks'][symbol]
-                st.success(f"Removed {symbol}!")
-                st.rerun()
+    holdings = pd.DataFrame.from_dict(stocks, orient='index')[['shares', 'avg_price']]
+    holdings['remove'] = False
+    
+    # Key the editor on its contents so saved changes start from a fresh grid
+    edited = st.data_editor(
+        holdings,
+        key=f"manage_{portfolio_name}_{state_hash(holdings.values.tolist())}",
+        use_container_width=True,
+        column_config={
+            '_index': st.column_config.TextColumn("Symbol"),
+            'shares': st.column_config.NumberColumn("Shares", min_value=0.05, step=0.05, required=True),
+            'avg_price': st.column_config.NumberColumn("Avg Price", min_value=0.01, step=0.01, format="$%.2f", required=True),
+            'remove': st.column_config.CheckboxColumn("Remove")
+        }
+    )
+    
+    if st.button("Save Changes", type="primary"):
+        # Apply only the rows that actually changed, then rerun the whole app
+        for symbol, row in edited.iterrows():
+            original = holdings.loc[symbol]
+            if row['remove']:
+                portfolio_manager.remove_stock(portfolio_name, symbol)
+            elif row['shares'] != original['shares'] or row['avg_price'] != original['avg_price']:
+                portfolio_manager.update_stock(portfolio_name, symbol, float(row['shares']), float(row['avg_price']))
         
-        st.divider()
+        st.success("Holdings updated!")
+        st.rerun()
 
 if __name__ == "__main__":
     main()
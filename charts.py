@@ -6,9 +6,12 @@ import numpy as np
 from datetime import datetime, timedelta
 from stock_data import StockDataManager
 
+LONG_PERIODS = ('2y', '5y')
+MAX_DAILY_CANDLES = 400
+
 class ChartManager:
-    def __init__(self):
-        self.stock_data_manager = StockDataManager()
+    def __init__(self, stock_data_manager=None):
+        self.stock_data_manager = stock_data_manager or StockDataManager()
         self.color_palette = {
             'positive': '#00C851',
             'negative': '#FF4444',
@@ -23,8 +26,18 @@ class ChartManager:
             if data is None or data.empty:
                 return None
             
-            # Create candlestick chart
-            fig = go.Figure()
+            # Long periods render weekly candles; daily detail is not visible at that scale
+            if period in LONG_PERIODS and len(data) > MAX_DAILY_CANDLES:
+                data = data.resample('W', on='Date').agg({
+                    'Open': 'first',
+                    'High': 'max',
+                    'Low': 'min',
+                    'Close': 'last',
+                    'Volume': 'sum'
+                }).dropna().reset_index()
+            
+            # Price and volume panels share one x-axis
+            fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.02, row_heights=[0.8, 0.2])
             
             fig.add_trace(go.Candlestick(
                 x=data['Date'],
@@ -35,34 +48,28 @@ class ChartManager:
                 name=symbol,
                 increasing_line_color=self.color_palette['positive'],
                 decreasing_line_color=self.color_palette['negative']
-            ))
+            ), row=1, col=1)
             
             # Add volume subplot
             fig.add_trace(go.Bar(
                 x=data['Date'],
                 y=data['Volume'],
                 name='Volume',
-                yaxis='y2',
                 opacity=0.3,
                 marker_color=self.color_palette['neutral']
-            ))
+            ), row=2, col=1)
             
             # Update layout
             fig.update_layout(
                 title=f'{symbol} Stock Price - {period}',
-                xaxis_title='Date',
-                yaxis_title='Price ($)',
-                yaxis2=dict(
-                    title='Volume',
-                    overlaying='y',
-                    side='right',
-                    showgrid=False
-                ),
                 template='plotly_white',
                 height=600,
                 showlegend=True,
                 hovermode='x unified'
             )
+            fig.update_yaxes(title_text='Price ($)', row=1, col=1)
+            fig.update_yaxes(title_text='Volume', showgrid=False, row=2, col=1)
+            fig.update_xaxes(title_text='Date', row=2, col=1)
             
             fig.update_xaxes(rangeslider_visible=False)
             
@@ -76,8 +83,8 @@ class ChartManager:
         """Create a pie chart showing portfolio composition"""
         try:
             # Extract data for pie chart
-            symbols = [item['Symbol'] for item in portfolio_data]
-            values = [float(item['current_value_raw']) for item in portfolio_data]
+            symbols = portfolio_data['Symbol']
+            values = portfolio_data['Current Value']
             
             # Create pie chart
             fig = go.Figure(data=[go.Pie(
@@ -104,58 +111,63 @@ class ChartManager:
             print(f"Error creating portfolio pie chart: {str(e)}")
             return None
     
-    def create_portfolio_performance_chart(self, symbols, stocks_info):
-        """Create a line chart showing portfolio performance over time"""
+    def calculate_portfolio_history(self, symbols, stocks_info, start=None):
+        """Calculate daily portfolio value over the last year, or from a start date (YYYY-MM-DD) onward"""
         try:
             # Get historical data for all symbols
-            all_data = self.stock_data_manager.get_portfolio_historical_data(symbols, "1y")
+            all_data = self.stock_data_manager.get_portfolio_historical_data(symbols, "1y", start)
             
             if not all_data:
                 return None
             
-            # Find common date range
-            min_date = None
-            max_date = None
-            
+            # Index each holding's closes by tz-naive date so histories fetched
+            # at different times line up
+            closes = {}
             for symbol, data in all_data.items():
-                if min_date is None or data['Date'].min() > min_date:
-                    min_date = data['Date'].min()
-                if max_date is None or data['Date'].max() < max_date:
-                    max_date = data['Date'].max()
-            
-            # Create a unified date range
-            date_range = pd.date_range(start=min_date, end=max_date, freq='D')
-            
-            # Calculate portfolio value over time
-            portfolio_values = []
-            dates = []
-            
-            for date in date_range:
-                if date.weekday() < 5:  # Only weekdays
-                    daily_value = 0
-                    valid_date = True
-                    
-                    for symbol, stock_info in stocks_info.items():
-                        if symbol in all_data:
-                            stock_data = all_data[symbol]
-                            # Find the closest date
-                            closest_date_idx = stock_data['Date'].sub(date).abs().idxmin()
-                            
-                            if abs((stock_data['Date'].iloc[closest_date_idx] - date).days) <= 7:
-                                price = stock_data['Close'].iloc[closest_date_idx]
-                                shares = stock_info['shares']
-                                daily_value += price * shares
-                            else:
-                                valid_date = False
-                                break
-                    
-                    if valid_date and daily_value > 0:
-                        portfolio_values.append(daily_value)
-                        dates.append(date)
+                dates = pd.DatetimeIndex(data['Date'])
+                if dates.tz is not None:
+                    dates = dates.tz_localize(None)
+                closes[symbol] = pd.Series(data['Close'].values, index=dates)
             
-            if not portfolio_values:
+            # Find common date range: latest first date to earliest last date
+            min_date = max(close.index.min() for close in closes.values())
+            max_date = min(close.index.max() for close in closes.values())
+            
+            # Create a unified date range of weekdays
+            date_range = pd.bdate_range(start=min_date, end=max_date)
+            
+            # Align every holding's closes onto the date range, carrying the
+            # last close forward for at most a week
+            held = [symbol for symbol in stocks_info if symbol in closes]
+            prices = pd.DataFrame({
+                symbol: closes[symbol].reindex(date_range, method='ffill', tolerance=pd.Timedelta('7D'))
+                for symbol in held
+            }, index=date_range)
+            shares = pd.Series({symbol: stocks_info[symbol]['shares'] for symbol in held}, dtype=float)
+            
+            # Calculate portfolio value over time, skipping dates where any holding lacks a price
+            portfolio_values = prices.dropna().mul(shares).sum(axis=1)
+            portfolio_values = portfolio_values[portfolio_values > 0]
+            
+            return portfolio_values
+            
+        except Exception as e:
+            print(f"Error calculating portfolio history: {str(e)}")
+            return None
+    
+    def create_portfolio_performance_chart(self, symbols, stocks_info, portfolio_values=None):
+        """Create a line chart showing portfolio performance over time"""
+        try:
+            # Reuse a precomputed value series when the caller has one
+            if portfolio_values is None:
+                portfolio_values = self.calculate_portfolio_history(symbols, stocks_info)
+            
+            if portfolio_values is None or portfolio_values.empty:
                 return None
             
+            dates = portfolio_values.index
+            portfolio_values = portfolio_values.astype('float32')
+            
             # Create line chart
             fig = go.Figure()
             
@@ -170,8 +182,8 @@ class ChartManager:
             
             # Add percentage change
             if len(portfolio_values) > 1:
-                initial_value = portfolio_values[0]
-                pct_changes = [(val - initial_value) / initial_value * 100 for val in portfolio_values]
+                initial_value = portfolio_values.iloc[0]
+                pct_changes = (portfolio_values - initial_value) / initial_value * 100
                 
                 fig.add_trace(go.Scatter(
                     x=dates,
@@ -207,8 +219,8 @@ class ChartManager:
     def create_gain_loss_chart(self, portfolio_data):
         """Create a bar chart showing gain/loss for each stock"""
         try:
-            symbols = [item['Symbol'] for item in portfolio_data]
-            gains_losses = [item['gain_loss_raw'] for item in portfolio_data]
+            symbols = portfolio_data['Symbol']
+            gains_losses = portfolio_data['Gain/Loss']
             
             # Color bars based on gain/loss
             colors = [self.color_palette['positive'] if val >= 0 else self.color_palette['negative'] for val in gains_losses]
@@ -244,8 +256,10 @@ class ChartManager:
         try:
             sector_data = {}
             
-            for symbol in symbols:
-                stock_info = self.stock_data_manager.get_stock_info(symbol)
+            # Fetch stock info concurrently; the lookups are independent network calls
+            all_info = self.stock_data_manager.fetch_all(self.stock_data_manager.get_stock_info, symbols)
+            
+            for stock_info in all_info:
                 if stock_info and stock_info['sector'] != 'N/A':
                     sector = stock_info['sector']
                     if sector in sector_data:
@@ -282,11 +296,16 @@ class ChartManager:
         try:
             fig = go.Figure()
             
-            for symbol in symbols:
-                data = self.stock_data_manager.get_historical_data(symbol, period)
+            # Fetch histories concurrently, then add traces in the original symbol order
+            all_data = self.stock_data_manager.fetch_all(
+                lambda symbol: self.stock_data_manager.get_historical_data(symbol, period), symbols
+            )
+            
+            for symbol, data in zip(symbols, all_data):
                 if data is not None and not data.empty:
-                    # Normalize prices (starting from 100)
-                    normalized_prices = (data['Close'] / data['Close'].iloc[0]) * 100
+                    # Normalize prices (starting from 100); closes arrive as float32
+                    close = data['Close']
+                    normalized_prices = (close / close.iloc[0]) * 100
                     
                     fig.add_trace(go.Scatter(
                         x=data['Date'],
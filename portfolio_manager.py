@@ -1,13 +1,72 @@
 import streamlit as st
 from datetime import datetime
-import json
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import copy
+import orjson
 import os
+import tempfile
+import threading
 from supabase_manager import SupabaseManager
 
+class PortfolioWriter:
+    """Run storage writes off the script thread, in order per key"""
+    
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="portfolio-writer")
+        self.lock = threading.Lock()
+        self.pending = {}
+    
+    def submit(self, key, func, *args, supersedes=False, errors=None):
+        """Queue func(*args) behind earlier writes for the same key"""
+        with self.lock:
+            queue = self.pending.get(key)
+            start_worker = queue is None
+            if start_worker:
+                queue = self.pending[key] = deque()
+            elif supersedes:
+                # A full snapshot or delete makes queued writes for the key redundant
+                queue.clear()
+            queue.append((func, args, errors))
+        
+        if start_worker:
+            self.executor.submit(self._drain, key)
+    
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                queue = self.pending[key]
+                if not queue:
+                    del self.pending[key]
+                    return
+                func, args, errors = queue.popleft()
+            
+            # The page has already rerun, so failures are handed back for the session to show
+            try:
+                if func(*args) is False:
+                    message = f"Error writing portfolio data for {key}"
+                else:
+                    message = None
+            except Exception as e:
+                message = f"Error writing portfolio data for {key}: {str(e)}"
+            if message and errors is not None:
+                errors.append(message)
+
+@st.cache_resource(show_spinner=False)
+def get_supabase_manager():
+    return SupabaseManager()
+
+# Shared across sessions: a rerun or new session reads the database only
+# after a write has invalidated this
+@st.cache_resource(max_entries=1, show_spinner=False)
+def _load_portfolios_cached(_supabase_manager):
+    return _supabase_manager.load_portfolios()
+
 class PortfolioManager:
     def __init__(self):
         self.portfolios_file = "portfolios.json"
-        self.supabase_manager = SupabaseManager()
+        self.writer = PortfolioWriter()
+        self.supabase_manager = get_supabase_manager()
         self.use_supabase = self.supabase_manager.is_connected()
         self.load_portfolios()
     
@@ -17,10 +76,11 @@ class PortfolioManager:
             if self.use_supabase:
                 # Try to migrate from JSON file if it exists
                 if os.path.exists(self.portfolios_file):
-                    self.supabase_manager.migrate_from_json(self.portfolios_file)
+                    if self.supabase_manager.migrate_from_json(self.portfolios_file):
+                        _load_portfolios_cached.clear()
                 
-                # Load from Supabase
-                portfolio_data = self.supabase_manager.load_portfolios()
+                # Load from Supabase; each session gets its own copy to mutate
+                portfolio_data = copy.deepcopy(_load_portfolios_cached(self.supabase_manager))
                 
                 if 'portfolios' not in st.session_state:
                     st.session_state.portfolios = portfolio_data
@@ -31,8 +91,8 @@ class PortfolioManager:
             else:
                 # Fallback to JSON file
                 if os.path.exists(self.portfolios_file):
-                    with open(self.portfolios_file, 'r') as f:
-                        data = json.load(f)
+                    with open(self.portfolios_file, 'rb') as f:
+                        data = orjson.loads(f.read())
                         # Convert date strings back to datetime objects
                         for portfolio_name, portfolio_data in data.items():
                             if 'created_date' in portfolio_data:
@@ -53,24 +113,54 @@ class PortfolioManager:
         """Save portfolios to Supabase or JSON file fallback"""
         try:
             if self.use_supabase:
-                for portfolio_name, portfolio_data in st.session_state.portfolios.items():
-                    self.supabase_manager.save_portfolio(portfolio_name, portfolio_data)
+                self.supabase_manager.save_portfolios_bulk(st.session_state.portfolios)
+                _load_portfolios_cached.clear()
             else:
-                # Fallback to JSON file
-                data = st.session_state.portfolios.copy()
-                # Convert datetime objects to strings for JSON serialization
-                for portfolio_name, portfolio_data in data.items():
-                    if 'created_date' in portfolio_data:
-                        portfolio_data['created_date'] = portfolio_data['created_date'].isoformat()
-                    for symbol, stock_data in portfolio_data.get('stocks', {}).items():
-                        if 'last_updated' in stock_data:
-                            stock_data['last_updated'] = stock_data['last_updated'].isoformat()
-                
-                with open(self.portfolios_file, 'w') as f:
-                    json.dump(data, f, indent=2)
+                # Serialising on the script thread is the snapshot: no copy of the
+                # portfolios, and session state is never touched. Only the file
+                # write happens in the background
+                data = orjson.dumps(st.session_state.portfolios,
+                                    option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+                self.writer.submit(self.portfolios_file, self._write_json, data, supersedes=True,
+                                   errors=self._write_errors())
         except Exception as e:
             st.error(f"Error saving portfolios: {str(e)}")
     
+    def _write_json(self, data):
+        """Write serialised portfolios to the JSON file"""
+        # Write beside the target and swap it in, so a concurrent load never sees a partial file
+        directory = os.path.dirname(os.path.abspath(self.portfolios_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".portfolios-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates the file owner-only; keep the permissions a plain open() would give
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.portfolios_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
+    def _submit_write(self, key, func, *args, supersedes=False):
+        """Queue a Supabase write and drop the cached load once it has landed"""
+        def write():
+            result = func(*args)
+            _load_portfolios_cached.clear()
+            return result
+        
+        self.writer.submit(key, write, supersedes=supersedes, errors=self._write_errors())
+    
+    def _write_errors(self):
+        """Return this session's list of failed background writes"""
+        # The manager is shared, so failures are collected per session in its state
+        return st.session_state.setdefault('write_errors', [])
+    
+    def report_write_errors(self):
+        """Show background write failures collected since the last rerun"""
+        errors = st.session_state.get('write_errors')
+        while errors:
+            st.error(errors.pop(0))
+    
     def create_portfolio(self, name):
         """Create a new portfolio"""
         if name not in st.session_state.portfolios:
@@ -81,7 +171,8 @@ class PortfolioManager:
             st.session_state.portfolios[name] = portfolio_data
             
             if self.use_supabase:
-                self.supabase_manager.save_portfolio(name, portfolio_data)
+                self._submit_write(name, self.supabase_manager.save_portfolio, name,
+                                   copy.deepcopy(portfolio_data), supersedes=True)
             else:
                 self.save_portfolios()
             return True
@@ -93,7 +184,7 @@ class PortfolioManager:
             del st.session_state.portfolios[name]
             
             if self.use_supabase:
-                self.supabase_manager.delete_portfolio(name)
+                self._submit_write(name, self.supabase_manager.delete_portfolio, name, supersedes=True)
             else:
                 self.save_portfolios()
             return True
@@ -125,7 +216,8 @@ class PortfolioManager:
                 }
             
             if self.use_supabase:
-                self.supabase_manager.add_stock(portfolio_name, symbol, shares, avg_price)
+                self._submit_write(portfolio_name, self.supabase_manager.add_stock,
+                                   portfolio_name, symbol, shares, avg_price)
             else:
                 self.save_portfolios()
             return True
@@ -139,7 +231,7 @@ class PortfolioManager:
                 del portfolio['stocks'][symbol]
                 
                 if self.use_supabase:
-                    self.supabase_manager.remove_stock(portfolio_name, symbol)
+                    self._submit_write(portfolio_name, self.supabase_manager.remove_stock, portfolio_name, symbol)
                 else:
                     self.save_portfolios()
                 return True
@@ -157,7 +249,8 @@ class PortfolioManager:
                 }
                 
                 if self.use_supabase:
-                    self.supabase_manager.update_stock(portfolio_name, symbol, shares, avg_price)
+                    self._submit_write(portfolio_name, self.supabase_manager.update_stock,
+                                       portfolio_name, symbol, shares, avg_price)
                 else:
                     self.save_portfolios()
                 return True
@@ -1,76 +1,282 @@
 import yfinance as yf
+from yfinance.exceptions import YFRateLimitError
+from curl_cffi.requests import exceptions as curl_exceptions
+import requests
+import asyncio
+from cachetools import TTLCache
+import diskcache
+import threading
+import os
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+SPARK_URL = "https://query1.finance.yahoo.com/v8/finance/spark"
+SPARK_BATCH_SIZE = 20  # Yahoo caps the spark endpoint at 20 symbols per request
+MAX_FETCH_WORKERS = 8  # Concurrent per-symbol requests to Yahoo; more invites 429s
+
+# Cache lifetimes matched to how often each kind of data changes
+PRICE_TTL = 60
+HISTORY_TTL = 900
+INFO_TTL = 86400
+RATE_LIMIT_TTL = 30  # How long to stop asking for a symbol after Yahoo keeps returning 429
+NEGATIVE_TTL = 60  # How long to remember that a lookup came back empty or failed
+VALID_TTL = 3600  # How long to trust that a symbol exists
+# Histories persisted across restarts; next to the code unless configured, so it
+# doesn't depend on the directory Streamlit was launched from
+DISK_CACHE_DIR = os.getenv('STOCK_CACHE_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'stock'))
+
+HISTORY_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+PRICE_COLUMNS = ['Open', 'High', 'Low', 'Close']
+
+def slim_history(hist):
+    """Keep only OHLCV with float32 prices, and Date as a column, to halve cached frame size"""
+    # Volume keeps its integer dtype: split-adjusted volumes can overflow int32
+    return hist[HISTORY_COLUMNS].astype({column: 'float32' for column in PRICE_COLUMNS}).reset_index()
+
+class NoDataError(Exception):
+    """Yahoo returned no data for a symbol"""
+
+def is_transient_yahoo_error(error):
+    """Tell rate limits, dropped connections and 5xx responses from errors worth giving up on"""
+    # yfinance talks to Yahoo through curl_cffi, whose exceptions don't derive from requests'
+    if isinstance(error, (YFRateLimitError, curl_exceptions.ConnectionError, curl_exceptions.Timeout)):
+        return True
+    if isinstance(error, curl_exceptions.HTTPError):
+        status = getattr(error.response, 'status_code', None)
+        return status is None or status >= 500
+    return False
+
+# Retry transient Yahoo failures and rate limits with jittered exponential backoff.
+# history() hides most errors behind an empty frame, so there it only retries 429s
+yahoo_retry = retry(
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(is_transient_yahoo_error),
+    reraise=True
+)
+
+# Streamlit-level caches shared across reruns and sessions
+@st.cache_data(ttl=PRICE_TTL, show_spinner=False)
+@yahoo_retry
+def _fetch_current_price(symbol):
+    """Fetch the current price for a symbol, with today's history when the price came from it"""
+    ticker = yf.Ticker(symbol)
+    
+    # Today's history is the cheapest reliable price source
+    hist = ticker.history(period="1d")
+    if not hist.empty:
+        return float(hist['Close'].iloc[-1]), slim_history(hist)
+    
+    # fast_info reads a lightweight quote endpoint instead of the full info scrape
+    try:
+        price = ticker.fast_info.get('last_price')
+    except Exception:
+        price = None
+    if price is not None:
+        return float(price), None
+    
+    # Raised rather than returned, so st.cache_data doesn't hold on to the miss
+    raise NoDataError(f"No price data for {symbol}")
+
+@st.cache_data(ttl=HISTORY_TTL, show_spinner=False)
+@yahoo_retry
+def _fetch_historical_data(symbol, period, start=None):
+    """Fetch historical data for a symbol from yfinance"""
+    ticker = yf.Ticker(symbol)
+    hist = ticker.history(start=start) if start else ticker.history(period=period)
+    
+    # yfinance reports most failures as an empty frame; raise so the miss isn't cached here
+    if hist.empty:
+        raise NoDataError(f"No historical data for {symbol}")
+    
+    # Reset index to make Date a column
+    return slim_history(hist)
+
+@st.cache_data(ttl=INFO_TTL, show_spinner=False)
+@yahoo_retry
+def _fetch_stock_info(symbol):
+    """Fetch the raw info dict for a symbol from yfinance"""
+    return yf.Ticker(symbol).info
 
 class StockDataManager:
     def __init__(self):
-        self.cache_duration = 300  # Cache for 5 minutes
-        self.price_cache = {}
-        self.data_cache = {}
+        # Bounded TTL caches evict expired and least-recently-used entries on
+        # their own; the lock guards them against the fetch threads
+        self.price_cache = TTLCache(maxsize=512, ttl=PRICE_TTL)
+        self.data_cache = TTLCache(maxsize=128, ttl=HISTORY_TTL)
+        self.cache_lock = threading.Lock()
+        self.fetch_locks = {}
+        self.rate_limited = TTLCache(maxsize=512, ttl=RATE_LIMIT_TTL)
+        self.missing_cache = TTLCache(maxsize=512, ttl=NEGATIVE_TTL)
+        self.valid_cache = TTLCache(maxsize=4096, ttl=VALID_TTL)
+        
+        # Second-level cache on disk, so restarts and cold deploys start warm
+        self.disk_cache = diskcache.Cache(DISK_CACHE_DIR)
+        
+        # Reuse pooled keep-alive connections for direct Yahoo requests
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': 'Mozilla/5.0'})
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
     
-    def get_current_price(self, symbol):
-        """Get current price for a stock symbol"""
+    def _get_or_fetch(self, cache, cache_key, fetch, persist=False):
+        """Return a cached value, or fetch it with at most one request in flight per key"""
+        with self.cache_lock:
+            cached_data = cache.get(cache_key)
+            if cached_data is not None:
+                return cached_data
+            if cache_key in self.rate_limited or cache_key in self.missing_cache:
+                return None
+            fetch_lock = self.fetch_locks.setdefault(cache_key, threading.Lock())
+        
+        # Locks live only while a fetch is in flight; once it finishes the cache or a
+        # negative cache answers for the key
         try:
-            # Check cache first
-            cache_key = f"{symbol}_price"
-            if cache_key in self.price_cache:
-                cached_data, timestamp = self.price_cache[cache_key]
-                if (datetime.now() - timestamp).seconds < self.cache_duration:
+            with fetch_lock:
+                # Another thread may have fetched it, or recorded a failure, while this one waited
+                with self.cache_lock:
+                    cached_data = cache.get(cache_key)
+                    if cached_data is None and (cache_key in self.rate_limited or cache_key in self.missing_cache):
+                        return None
+                # Only persisted keys (histories) use the disk; prices are short-lived and
+                # st.cache_data already shares them across sessions
+                if cached_data is None and persist:
+                    cached_data = self.disk_cache.get(cache_key)
+                    if cached_data is not None:
+                        with self.cache_lock:
+                            cache[cache_key] = cached_data
+                if cached_data is not None:
                     return cached_data
+                
+                try:
+                    value = fetch()
+                except NoDataError:
+                    # Nothing to show the user; just don't ask again for a while
+                    with self.cache_lock:
+                        self.missing_cache[cache_key] = True
+                    return None
+                except YFRateLimitError:
+                    # Still rate limited after retrying: back off instead of re-requesting on every rerun
+                    with self.cache_lock:
+                        self.rate_limited[cache_key] = True
+                    raise
+                except Exception:
+                    with self.cache_lock:
+                        self.missing_cache[cache_key] = True
+                    raise
+                
+                # Remember misses briefly too, so a bad symbol isn't re-queried on every rerun
+                with self.cache_lock:
+                    if value is not None:
+                        cache[cache_key] = value
+                    else:
+                        self.missing_cache[cache_key] = True
+                if value is not None and persist:
+                    self.disk_cache.set(cache_key, value, expire=cache.ttl)
+                return value
+        finally:
+            with self.cache_lock:
+                if self.fetch_locks.get(cache_key) is fetch_lock:
+                    del self.fetch_locks[cache_key]
+    
+    async def _gather_limited(self, fetch, symbols):
+        """Run fetch for every symbol on worker threads, at most MAX_FETCH_WORKERS at once"""
+        semaphore = asyncio.Semaphore(MAX_FETCH_WORKERS)
+        
+        # Hand the script's context to the workers so their st.error calls still reach the page
+        ctx = get_script_run_ctx()
+        
+        def run(symbol):
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return fetch(symbol)
+        
+        async def fetch_one(symbol):
+            async with semaphore:
+                return await asyncio.to_thread(run, symbol)
+        
+        return await asyncio.gather(*(fetch_one(symbol) for symbol in symbols))
+    
+    def fetch_all(self, fetch, symbols):
+        """Fetch every symbol concurrently and return the results in the same order"""
+        return asyncio.run(self._gather_limited(fetch, symbols))
+    
+    def get_current_price(self, symbol):
+        """Get current price for a stock symbol"""
+        def fetch():
+            price, hist = _fetch_current_price(symbol)
             
-            # Fetch from yfinance
-            ticker = yf.Ticker(symbol)
-            info = ticker.info
-            
-            # Try different price fields
-            current_price = None
-            for price_field in ['regularMarketPrice', 'currentPrice', 'price', 'ask', 'bid']:
-                if price_field in info and info[price_field] is not None:
-                    current_price = float(info[price_field])
-                    break
-            
-            # If info doesn't have price, try recent history
-            if current_price is None:
-                hist = ticker.history(period="1d")
-                if not hist.empty:
-                    current_price = float(hist['Close'].iloc[-1])
-            
-            # Cache the result
-            if current_price is not None:
-                self.price_cache[cache_key] = (current_price, datetime.now())
-            
-            return current_price
+            # The day's history came along with the price, so serve 1d history requests from it too
+            if hist is not None:
+                with self.cache_lock:
+                    self.data_cache[f"{symbol}_1d"] = hist
+            return price
+        
+        try:
+            return self._get_or_fetch(self.price_cache, f"{symbol}_price", fetch)
             
         except Exception as e:
             st.error(f"Error fetching price for {symbol}: {str(e)}")
             return None
     
-    def get_historical_data(self, symbol, period="1y"):
-        """Get historical data for a stock symbol"""
-        try:
-            # Check cache first
-            cache_key = f"{symbol}_{period}"
-            if cache_key in self.data_cache:
-                cached_data, timestamp = self.data_cache[cache_key]
-                if (datetime.now() - timestamp).seconds < self.cache_duration:
-                    return cached_data
-            
-            # Fetch from yfinance
-            ticker = yf.Ticker(symbol)
-            hist = ticker.history(period=period)
-            
-            if hist.empty:
-                return None
-            
-            # Reset index to make Date a column
-            hist = hist.reset_index()
-            
-            # Cache the result
-            self.data_cache[cache_key] = (hist, datetime.now())
+    def get_current_prices(self, symbols):
+        """Get current prices for many symbols using batched spark requests"""
+        prices = {}
+        missing = []
+        
+        # Serve what we can from cache
+        with self.cache_lock:
+            for symbol in symbols:
+                cached_data = self.price_cache.get(f"{symbol}_price")
+                if cached_data is not None:
+                    prices[symbol] = cached_data
+                else:
+                    missing.append(symbol)
+        
+        # One request per chunk of up to 20 symbols
+        for i in range(0, len(missing), SPARK_BATCH_SIZE):
+            chunk = missing[i:i + SPARK_BATCH_SIZE]
+            try:
+                response = self.session.get(
+                    SPARK_URL,
+                    params={'symbols': ','.join(chunk), 'range': '1d', 'interval': '5m'},
+                    timeout=10
+                )
+                response.raise_for_status()
+                data = response.json()
+            except Exception:
+                continue
             
-            return hist
+            for symbol in chunk:
+                closes = [c for c in (data.get(symbol) or {}).get('close') or [] if c is not None]
+                if closes:
+                    prices[symbol] = float(closes[-1])
+                    with self.cache_lock:
+                        self.price_cache[f"{symbol}_price"] = prices[symbol]
+        
+        # Fall back to a batched download for anything the spark requests missed
+        remaining = [symbol for symbol in missing if symbol not in prices]
+        if remaining:
+            prices.update(self.get_multiple_prices(remaining))
+        
+        return prices
+    
+    def get_historical_data(self, symbol, period="1y", start=None):
+        """Get historical data for a stock symbol, optionally from a start date (YYYY-MM-DD) onward"""
+        try:
+            cache_key = f"{symbol}_{start}" if start else f"{symbol}_{period}"
+            return self._get_or_fetch(self.data_cache, cache_key,
+                                      lambda: _fetch_historical_data(symbol, period, start), persist=True)
             
         except Exception as e:
             st.error(f"Error fetching historical data for {symbol}: {str(e)}")
@@ -79,8 +285,7 @@ class StockDataManager:
     def get_stock_info(self, symbol):
         """Get basic information about a stock"""
         try:
-            ticker = yf.Ticker(symbol)
-            info = ticker.info
+            info = _fetch_stock_info(symbol)
             
             stock_info = {
                 'symbol': symbol,
@@ -103,8 +308,34 @@ class StockDataManager:
     
     def validate_symbol(self, symbol):
         """Validate if a stock symbol exists"""
+        cache_key = f"{symbol}_valid"
+        with self.cache_lock:
+            if symbol in self.valid_cache:
+                return True
+            if cache_key in self.missing_cache:
+                return False
+        
+        # Hits are kept for an hour; misses only briefly, since they may be transient network errors
+        valid = self._lookup_symbol(symbol)
+        with self.cache_lock:
+            if valid:
+                self.valid_cache[symbol] = True
+            else:
+                self.missing_cache[cache_key] = True
+        return valid
+    
+    def _lookup_symbol(self, symbol):
+        """Check with Yahoo whether a stock symbol exists"""
         try:
             ticker = yf.Ticker(symbol)
+            
+            # A quoted last price is enough to know the symbol exists
+            try:
+                if ticker.fast_info.get('last_price') is not None:
+                    return True
+            except Exception:
+                pass
+            
             info = ticker.info
             
             # Check if we got valid info
@@ -119,30 +350,55 @@ class StockDataManager:
             return False
     
     def get_multiple_prices(self, symbols):
-        """Get current prices for multiple symbols"""
+        """Get current prices for multiple symbols with one batched download"""
         prices = {}
-        for symbol in symbols:
-            price = self.get_current_price(symbol)
-            if price is not None:
-                prices[symbol] = price
+        
+        if len(symbols) > 1:
+            try:
+                data = yf.download(
+                    tickers=" ".join(symbols),
+                    period="1d",
+                    interval="1d",
+                    group_by="ticker",
+                    threads=True,
+                    progress=False,
+                    auto_adjust=False
+                )
+            except Exception:
+                data = None
+            
+            if data is not None and not data.empty:
+                for symbol in symbols:
+                    if symbol not in data.columns.get_level_values(0):
+                        continue
+                    closes = data[symbol]['Close'].dropna()
+                    if not closes.empty:
+                        prices[symbol] = float(closes.iloc[-1])
+                        with self.cache_lock:
+                            self.price_cache[f"{symbol}_price"] = prices[symbol]
+        
+        # Single symbols, and anything missing from the batch, go through the per-ticker path
+        missing = [symbol for symbol in symbols if symbol not in prices]
+        if missing:
+            for symbol, price in zip(missing, self.fetch_all(self.get_current_price, missing)):
+                if price is not None:
+                    prices[symbol] = price
         return prices
     
     def calculate_portfolio_value(self, portfolio_stocks):
         """Calculate total portfolio value"""
-        total_value = 0
-        total_cost = 0
-        
-        for symbol, stock_info in portfolio_stocks.items():
-            current_price = self.get_current_price(symbol)
-            if current_price is not None:
-                shares = stock_info['shares']
-                avg_price = stock_info['avg_price']
-                
-                current_value = current_price * shares
-                cost_basis = avg_price * shares
-                
-                total_value += current_value
-                total_cost += cost_basis
+        # Fetch every price up front in batches rather than one request per stock
+        prices = self.get_current_prices(list(portfolio_stocks.keys()))
+        
+        count = len(portfolio_stocks)
+        shares = np.fromiter((info['shares'] for info in portfolio_stocks.values()), dtype=np.float64, count=count)
+        avg_prices = np.fromiter((info['avg_price'] for info in portfolio_stocks.values()), dtype=np.float64, count=count)
+        current_prices = np.fromiter((prices.get(symbol, np.nan) for symbol in portfolio_stocks), dtype=np.float64, count=count)
+        
+        # Holdings without a current price count toward neither value nor cost
+        priced = ~np.isnan(current_prices)
+        total_value = float(current_prices[priced] @ shares[priced])
+        total_cost = float(avg_prices[priced] @ shares[priced])
         
         return {
             'total_value': total_value,
@@ -151,12 +407,15 @@ class StockDataManager:
             'total_gain_loss_pct': ((total_value - total_cost) / total_cost * 100) if total_cost > 0 else 0
         }
     
-    def get_portfolio_historical_data(self, symbols, period="1y"):
+    def get_portfolio_historical_data(self, symbols, period="1y", start=None):
         """Get historical data for multiple symbols"""
         all_data = {}
+        if not symbols:
+            return all_data
         
-        for symbol in symbols:
-            data = self.get_historical_data(symbol, period)
+        # Each symbol is an independent request, so fetch them concurrently
+        results = self.fetch_all(lambda symbol: self.get_historical_data(symbol, period, start), symbols)
+        for symbol, data in zip(symbols, results):
             if data is not None:
                 all_data[symbol] = data
         
@@ -164,5 +423,15 @@ class StockDataManager:
     
     def clear_cache(self):
         """Clear all cached data"""
-        self.price_cache.clear()
-        self.data_cache.clear()
+        with self.cache_lock:
+            self.price_cache.clear()
+            self.data_cache.clear()
+            self.rate_limited.clear()
+            self.missing_cache.clear()
+            self.valid_cache.clear()
+        self.disk_cache.clear()
+        
+        # The shared Streamlit caches sit in front of the fetches, so clear them too
+        _fetch_current_price.clear()
+        _fetch_historical_data.clear()
+        _fetch_stock_info.clear()
@@ -1,14 +1,26 @@
 import os
-import streamlit as st
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+import functools
+from sqlalchemy import create_engine, inspect, func, bindparam, insert, select, update, delete, text, Column, Integer, String, Float, DateTime, ForeignKey, Index, Text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool
 from datetime import datetime
 import json
 
+def _notify(level, message):
+    """Show a Streamlit message; Streamlit is only imported once there is something to show"""
+    import streamlit as st
+    getattr(st, level)(message)
+
 # Supabase Database setup
 Base = declarative_base()
 
+# Schema checks cost a round trip per table, so run them once per process
+_tables_created = False
+# Whether the stocks foreign key is known to cascade deletes from portfolios
+_stocks_cascade = False
+
 class Portfolio(Base):
     __tablename__ = "portfolios"
     
@@ -17,10 +29,14 @@ class Portfolio(Base):
     created_date = Column(DateTime, default=datetime.utcnow)
     
     # Relationship with stocks
-    stocks = relationship("Stock", back_populates="portfolio", cascade="all, delete-orphan")
+    stocks = relationship("Stock", back_populates="portfolio", cascade="all, delete-orphan", passive_deletes=True)
 
 class Stock(Base):
     __tablename__ = "stocks"
+    __table_args__ = (
+        # One row per symbol per portfolio; also the conflict target for add_stock's UPSERT
+        Index('ix_stock_portfolio_symbol', 'portfolio_id', 'symbol', unique=True),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     symbol = Column(String, index=True)
@@ -29,13 +45,40 @@ class Stock(Base):
     last_updated = Column(DateTime, default=datetime.utcnow)
     
     # Foreign key to portfolio
-    portfolio_id = Column(Integer, ForeignKey("portfolios.id"))
+    portfolio_id = Column(Integer, ForeignKey("portfolios.id", ondelete="CASCADE"))
     portfolio = relationship("Portfolio", back_populates="stocks")
 
+# Fixed-shape bulk stock INSERT, built once: reusing the same statement lets
+# every call hit the engine's compiled cache without rebuilding it
+STOCK_INSERT = Stock.__table__.insert()
+
+@functools.lru_cache(maxsize=None)
+def get_engine(database_url, use_pool=True):
+    """Create one pooled engine per database URL for the life of the process"""
+    # Large batched INSERTs go out in pages of up to 10k rows
+    if not use_pool:
+        # Behind an external pooler (e.g. Supabase's transaction pooler) or on
+        # serverless hosts, open a connection per checkout instead
+        return create_engine(database_url, poolclass=NullPool, insertmanyvalues_page_size=10000)
+    
+    # Keep warm connections across reruns: pre-ping drops dead ones, recycling
+    # stays under Supabase's idle timeouts, and LIFO checkout reuses the most
+    # recently used connections so idle extras can time out
+    return create_engine(
+        database_url,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_use_lifo=True,
+        insertmanyvalues_page_size=10000
+    )
+
 class SupabaseManager:
     def __init__(self):
         self.engine = None
         self.SessionLocal = None
+        self._portfolio_ids = {}
         self.initialize_connection()
     
     def initialize_connection(self):
@@ -44,24 +87,107 @@ class SupabaseManager:
             # Get Supabase URL from environment or secrets
             supabase_url = os.getenv('SUPABASE_URL')
             if not supabase_url:
-                st.warning("⚠️ Supabase URL not configured. Using JSON file storage as fallback.")
+                _notify('warning', "⚠️ Supabase URL not configured. Using JSON file storage as fallback.")
                 return False
             
-            self.engine = create_engine(supabase_url)
-            self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+            use_pool = os.getenv('SUPABASE_NULLPOOL', '').lower() not in ('1', 'true', 'yes')
+            self.engine = get_engine(supabase_url, use_pool)
+            
+            # Thread-local sessions: storage writes run on background threads
+            self.SessionLocal = scoped_session(
+                sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine)
+            )
             self.create_tables()
             return True
             
         except Exception as e:
-            st.warning(f"⚠️ Could not connect to Supabase: {str(e)}. Using JSON file storage as fallback.")
+            _notify('warning', f"⚠️ Could not connect to Supabase: {str(e)}. Using JSON file storage as fallback.")
             return False
     
     def create_tables(self):
         """Create database tables"""
+        global _tables_created, _stocks_cascade
+        if _tables_created:
+            return
+        
         try:
             Base.metadata.create_all(bind=self.engine)
         except Exception as e:
-            st.error(f"Error creating database tables: {str(e)}")
+            _notify('error', f"Error creating database tables: {str(e)}")
+            return
+        
+        # create_all skips tables that already exist, so upgrade older schemas
+        # separately; each step stands on its own so one failure doesn't block the other
+        upgraded = True
+        try:
+            self.create_stock_indexes()
+        except Exception as e:
+            upgraded = False
+            _notify('error', f"Error creating stock indexes; adding stocks may fail until they exist: {str(e)}")
+        
+        if self.engine.dialect.name == 'postgresql':
+            try:
+                self.upgrade_stock_foreign_key()
+                _stocks_cascade = True
+            except Exception as e:
+                upgraded = False
+                _notify('warning', f"Could not make stocks cascade on portfolio delete; "
+                                   f"deleting a portfolio will remove its stocks first: {str(e)}")
+        _tables_created = upgraded
+    
+    def create_stock_indexes(self):
+        """Create any Stock indexes missing from tables built by older versions"""
+        with self.engine.begin() as conn:
+            existing = {index['name'] for index in inspect(conn).get_indexes('stocks')}
+            for index in Stock.__table__.indexes:
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    self.merge_duplicate_stocks(conn)
+                index.create(bind=conn)
+    
+    def merge_duplicate_stocks(self, conn):
+        """Fold repeated (portfolio_id, symbol) rows into one so the unique index can be built"""
+        stocks = Stock.__table__
+        total_shares = func.sum(stocks.c.shares)
+        duplicates = conn.execute(
+            select(
+                func.min(stocks.c.id),
+                total_shares,
+                func.coalesce(func.sum(stocks.c.shares * stocks.c.avg_price) / func.nullif(total_shares, 0),
+                              func.max(stocks.c.avg_price))
+            )
+            .group_by(stocks.c.portfolio_id, stocks.c.symbol)
+            .having(func.count() > 1)
+        ).all()
+        if not duplicates:
+            return
+        
+        # Keep the oldest row with the combined position, as add_stock would have built it
+        conn.execute(
+            update(stocks)
+            .where(stocks.c.id == bindparam('keep_id'))
+            .values(shares=bindparam('total_shares'), avg_price=bindparam('merged_price')),
+            [{'keep_id': keep_id, 'total_shares': shares, 'merged_price': price}
+             for keep_id, shares, price in duplicates]
+        )
+        keep_ids = select(func.min(stocks.c.id)).group_by(stocks.c.portfolio_id, stocks.c.symbol)
+        conn.execute(delete(stocks).where(stocks.c.id.not_in(keep_ids)))
+    
+    def upgrade_stock_foreign_key(self):
+        """Make deleting a portfolio cascade to its stocks in tables created before ON DELETE CASCADE"""
+        with self.engine.begin() as conn:
+            constraints = conn.execute(text(
+                "SELECT conname FROM pg_constraint "
+                "WHERE conrelid = 'stocks'::regclass AND contype = 'f' AND confdeltype <> 'c'"
+            )).scalars().all()
+            for name in constraints:
+                conn.execute(text(f'ALTER TABLE stocks DROP CONSTRAINT "{name}"'))
+            if constraints:
+                conn.execute(text(
+                    "ALTER TABLE stocks ADD CONSTRAINT stocks_portfolio_id_fkey "
+                    "FOREIGN KEY (portfolio_id) REFERENCES portfolios (id) ON DELETE CASCADE"
+                ))
     
     def get_db_session(self):
         """Get database session"""
@@ -73,209 +199,265 @@ class SupabaseManager:
         """Check if connected to Supabase"""
         return self.engine is not None and self.SessionLocal is not None
     
+    def get_portfolio_id(self, session, portfolio_name):
+        """Look up a portfolio id, querying only when it isn't already known"""
+        portfolio_id = self._portfolio_ids.get(portfolio_name)
+        if portfolio_id is None:
+            portfolio_id = session.execute(
+                select(Portfolio.id).where(Portfolio.name == portfolio_name)
+            ).scalar_one_or_none()
+            if portfolio_id is not None:
+                self._portfolio_ids[portfolio_name] = portfolio_id
+        return portfolio_id
+    
+    def execute_for_portfolio(self, portfolio_name, build_statement):
+        """Run build_statement(portfolio_id) and commit, re-reading a stale cached id once"""
+        for attempt in range(2):
+            from_cache = portfolio_name in self._portfolio_ids
+            with self.get_db_session() as session:
+                portfolio_id = self.get_portfolio_id(session, portfolio_name)
+                if portfolio_id is None:
+                    return None
+                
+                try:
+                    result = session.execute(build_statement(portfolio_id))
+                    session.commit()
+                except IntegrityError:
+                    # Foreign key violation: the cached id belongs to a deleted portfolio
+                    self._portfolio_ids.pop(portfolio_name, None)
+                    if from_cache and attempt == 0:
+                        continue
+                    raise
+                
+                # Nothing matched; make sure that isn't down to a stale cached id
+                if result.rowcount == 0 and from_cache and attempt == 0:
+                    self._portfolio_ids.pop(portfolio_name, None)
+                    continue
+                return result
+    
     def load_portfolios(self):
         """Load portfolios from Supabase database"""
         if not self.is_connected():
             return {}
             
         try:
-            session = self.get_db_session()
-            portfolios = session.query(Portfolio).all()
+            # One LEFT JOIN for portfolios and their stocks; plain rows skip ORM object construction.
+            # The session closes (even on error) and releases its connection before the rows are processed
+            with self.get_db_session() as session:
+                rows = session.execute(
+                    select(Portfolio.id, Portfolio.name, Portfolio.created_date,
+                           Stock.symbol, Stock.shares, Stock.avg_price, Stock.last_updated)
+                    .join(Stock, Stock.portfolio_id == Portfolio.id, isouter=True)
+                ).all()
             
             portfolio_data = {}
-            for portfolio in portfolios:
-                stocks_data = {}
-                for stock in portfolio.stocks:
-                    stocks_data[stock.symbol] = {
-                        'shares': stock.shares,
-                        'avg_price': stock.avg_price,
-                        'last_updated': stock.last_updated
-                    }
+            portfolio_ids = {}
+            for row in rows:
+                portfolio = portfolio_data.setdefault(row.name, {
+                    'stocks': {},
+                    'created_date': row.created_date
+                })
+                portfolio_ids[row.name] = row.id
                 
-                portfolio_data[portfolio.name] = {
-                    'stocks': stocks_data,
-                    'created_date': portfolio.created_date
-                }
+                # Portfolios without stocks come back as a single row of NULLs
+                if row.symbol is not None:
+                    portfolio['stocks'][row.symbol] = {
+                        'shares': row.shares,
+                        'avg_price': row.avg_price,
+                        'last_updated': row.last_updated
+                    }
             
-            session.close()
+            self._portfolio_ids = portfolio_ids
             return portfolio_data
             
         except Exception as e:
-            st.error(f"Error loading portfolios from Supabase: {str(e)}")
+            _notify('error', f"Error loading portfolios from Supabase: {str(e)}")
             return {}
     
+    # The single-portfolio writes run on the background writer, where Streamlit can't show
+    # messages; they raise instead, and the writer reports the error to the session
     def save_portfolio(self, portfolio_name, portfolio_data):
         """Save or update a portfolio in Supabase"""
         if not self.is_connected():
             return False
             
-        session = self.get_db_session()
-        try:
-            # Check if portfolio exists
-            existing_portfolio = session.query(Portfolio).filter(Portfolio.name == portfolio_name).first()
+        with self.get_db_session() as session:
+            stocks = portfolio_data.get('stocks', {})
+            stock_table = Stock.__table__
             
-            if existing_portfolio:
-                # Update existing portfolio
-                portfolio_obj = existing_portfolio
+            # Create the portfolio unless it exists, getting its ID back from the INSERT itself.
+            # The cached id isn't trusted here: another process may have deleted or re-created it
+            portfolio_id = session.execute(
+                pg_insert(Portfolio)
+                .values(name=portfolio_name,
+                        created_date=portfolio_data.get('created_date', datetime.utcnow()))
+                .on_conflict_do_nothing(index_elements=['name'])
+                .returning(Portfolio.id)
+            ).scalar_one_or_none()
+            existing = portfolio_id is None
+            
+            if existing:
+                portfolio_id = session.execute(
+                    select(Portfolio.id).where(Portfolio.name == portfolio_name)
+                ).scalar_one()
                 
-                # Clear existing stocks
-                session.query(Stock).filter(Stock.portfolio_id == portfolio_obj.id).delete()
-            else:
-                # Create new portfolio
-                portfolio_obj = Portfolio(
-                    name=portfolio_name,
-                    created_date=portfolio_data.get('created_date', datetime.utcnow())
+                # Drop only the symbols no longer held; the rest are updated in place below
+                session.execute(
+                    stock_table.delete().where(stock_table.c.portfolio_id == portfolio_id,
+                                               stock_table.c.symbol.not_in(list(stocks)))
                 )
-                session.add(portfolio_obj)
-                session.flush()  # To get the ID
             
-            # Add stocks
-            for symbol, stock_data in portfolio_data.get('stocks', {}).items():
-                stock_obj = Stock(
-                    symbol=symbol,
-                    shares=stock_data['shares'],
-                    avg_price=stock_data['avg_price'],
-                    portfolio_id=portfolio_obj.id
+            stock_rows = [
+                {'symbol': symbol,
+                 'shares': stock_data['shares'],
+                 'avg_price': stock_data['avg_price'],
+                 'portfolio_id': portfolio_id,
+                 'last_updated': datetime.utcnow()}
+                for symbol, stock_data in stocks.items()
+            ]
+            if stock_rows and existing:
+                # One UPSERT writes every position, leaving unchanged rows' identities intact
+                stmt = pg_insert(stock_table).values(stock_rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['portfolio_id', 'symbol'],
+                    set_={
+                        'shares': stmt.excluded.shares,
+                        'avg_price': stmt.excluded.avg_price,
+                        'last_updated': stmt.excluded.last_updated
+                    }
                 )
-                session.add(stock_obj)
+                session.execute(stmt)
+            elif stock_rows:
+                # Core table insert goes straight to the driver's executemany, batched by insertmanyvalues
+                session.execute(STOCK_INSERT, stock_rows)
             
             session.commit()
+            self._portfolio_ids[portfolio_name] = portfolio_id
             return True
-            
-        except Exception as e:
-            session.rollback()
-            st.error(f"Error saving portfolio to Supabase: {str(e)}")
-            return False
-        finally:
-            session.close()
     
-    def delete_portfolio(self, portfolio_name):
-        """Delete a portfolio from Supabase"""
+    def save_portfolios_bulk(self, portfolios):
+        """Save or update many portfolios in a single transaction"""
         if not self.is_connected():
             return False
             
-        session = self.get_db_session()
         try:
-            portfolio = session.query(Portfolio).filter(Portfolio.name == portfolio_name).first()
-            if portfolio:
-                session.delete(portfolio)
+            with self.get_db_session() as session:
+                # Read every id in one query rather than trusting the cached ones, which another
+                # process may have invalidated by deleting or re-creating a portfolio
+                names = list(portfolios.keys())
+                portfolio_ids = dict(
+                    session.execute(
+                        select(Portfolio.name, Portfolio.id).where(Portfolio.name.in_(names))
+                    ).tuples().all()
+                )
+                
+                # Insert missing portfolios in one statement and collect their IDs
+                new_names = [name for name in names if name not in portfolio_ids]
+                if new_names:
+                    new_ids = session.scalars(
+                        insert(Portfolio).returning(Portfolio.id, sort_by_parameter_order=True),
+                        [{'name': name,
+                          'created_date': portfolios[name].get('created_date', datetime.utcnow())}
+                         for name in new_names]
+                    ).all()
+                    portfolio_ids.update(zip(new_names, new_ids))
+                
+                # Replace every portfolio's stocks with one DELETE and one batched INSERT
+                session.execute(
+                    Stock.__table__.delete().where(Stock.__table__.c.portfolio_id.in_(list(portfolio_ids.values())))
+                )
+                
+                stock_rows = [
+                    {'symbol': symbol,
+                     'shares': stock_data['shares'],
+                     'avg_price': stock_data['avg_price'],
+                     'portfolio_id': portfolio_ids[name]}
+                    for name, portfolio_data in portfolios.items()
+                    for symbol, stock_data in portfolio_data.get('stocks', {}).items()
+                ]
+                if stock_rows:
+                    # Core table insert goes straight to the driver's executemany, batched by insertmanyvalues
+                    session.execute(STOCK_INSERT, stock_rows)
+                
                 session.commit()
+                self._portfolio_ids.update(portfolio_ids)
                 return True
-            else:
-                return False
                 
         except Exception as e:
-            session.rollback()
-            st.error(f"Error deleting portfolio from Supabase: {str(e)}")
+            _notify('error', f"Error saving portfolios to Supabase: {str(e)}")
             return False
-        finally:
-            session.close()
     
-    def add_stock(self, portfolio_name, symbol, shares, avg_price):
-        """Add or update a stock in a portfolio"""
+    def delete_portfolio(self, portfolio_name):
+        """Delete a portfolio from Supabase"""
         if not self.is_connected():
             return False
             
-        session = self.get_db_session()
-        try:
-            portfolio = session.query(Portfolio).filter(Portfolio.name == portfolio_name).first()
-            if not portfolio:
-                return False
-            
-            # Check if stock already exists
-            existing_stock = session.query(Stock).filter(
-                Stock.portfolio_id == portfolio.id,
-                Stock.symbol == symbol
-            ).first()
-            
-            if existing_stock:
-                # Update existing stock (average the positions)
-                total_shares = existing_stock.shares + shares
-                total_cost = (existing_stock.shares * existing_stock.avg_price) + (shares * avg_price)
-                new_avg_price = total_cost / total_shares
-                
-                existing_stock.shares = total_shares
-                existing_stock.avg_price = new_avg_price
-            else:
-                # Create new stock
-                new_stock = Stock(
-                    symbol=symbol,
-                    shares=shares,
-                    avg_price=avg_price,
-                    portfolio_id=portfolio.id
-                )
-                session.add(new_stock)
-            
+        with self.get_db_session() as session:
+            # The database cascades the delete to the portfolio's stocks, once
+            # the foreign key has been upgraded; until then delete them here
+            self._portfolio_ids.pop(portfolio_name, None)
+            if not _stocks_cascade:
+                portfolio_ids = select(Portfolio.id).where(Portfolio.name == portfolio_name)
+                session.execute(delete(Stock).where(Stock.portfolio_id.in_(portfolio_ids)))
+            session.execute(delete(Portfolio).where(Portfolio.name == portfolio_name))
             session.commit()
             return True
-            
-        except Exception as e:
-            session.rollback()
-            st.error(f"Error adding stock to Supabase: {str(e)}")
+    
+    def add_stock(self, portfolio_name, symbol, shares, avg_price):
+        """Add or update a stock in a portfolio"""
+        if not self.is_connected():
             return False
-        finally:
-            session.close()
+            
+        def build_statement(portfolio_id):
+            # Insert the position, or average it into the existing one, in a single statement
+            stmt = pg_insert(Stock).values(
+                portfolio_id=portfolio_id,
+                symbol=symbol,
+                shares=shares,
+                avg_price=avg_price,
+                last_updated=datetime.utcnow()
+            )
+            return stmt.on_conflict_do_update(
+                index_elements=['portfolio_id', 'symbol'],
+                set_={
+                    'shares': Stock.shares + stmt.excluded.shares,
+                    'avg_price': (Stock.shares * Stock.avg_price + stmt.excluded.shares * stmt.excluded.avg_price)
+                                 / (Stock.shares + stmt.excluded.shares),
+                    'last_updated': stmt.excluded.last_updated
+                }
+            )
+        
+        if self.execute_for_portfolio(portfolio_name, build_statement) is None:
+            raise LookupError(f"Portfolio '{portfolio_name}' not found")
+        return True
     
     def remove_stock(self, portfolio_name, symbol):
         """Remove a stock from a portfolio"""
         if not self.is_connected():
             return False
             
-        session = self.get_db_session()
-        try:
-            portfolio = session.query(Portfolio).filter(Portfolio.name == portfolio_name).first()
-            if not portfolio:
-                return False
-            
-            stock = session.query(Stock).filter(
-                Stock.portfolio_id == portfolio.id,
-                Stock.symbol == symbol
-            ).first()
-            
-            if stock:
-                session.delete(stock)
-                session.commit()
-                return True
-            else:
-                return False
-                
-        except Exception as e:
-            session.rollback()
-            st.error(f"Error removing stock from Supabase: {str(e)}")
-            return False
-        finally:
-            session.close()
+        # Nothing to remove is as good as removed
+        stock_table = Stock.__table__
+        self.execute_for_portfolio(
+            portfolio_name,
+            lambda portfolio_id: stock_table.delete().where(stock_table.c.portfolio_id == portfolio_id,
+                                                            stock_table.c.symbol == symbol)
+        )
+        return True
     
     def update_stock(self, portfolio_name, symbol, shares, avg_price):
         """Update a stock position"""
         if not self.is_connected():
             return False
             
-        session = self.get_db_session()
-        try:
-            portfolio = session.query(Portfolio).filter(Portfolio.name == portfolio_name).first()
-            if not portfolio:
-                return False
-            
-            stock = session.query(Stock).filter(
-                Stock.portfolio_id == portfolio.id,
-                Stock.symbol == symbol
-            ).first()
-            
-            if stock:
-                stock.shares = shares
-                stock.avg_price = avg_price
-                session.commit()
-                return True
-            else:
-                return False
-                
-        except Exception as e:
-            session.rollback()
-            st.error(f"Error updating stock in Supabase: {str(e)}")
-            return False
-        finally:
-            session.close()
+        # The caller already holds the final position, so write it without reading it back
+        self.execute_for_portfolio(
+            portfolio_name,
+            lambda portfolio_id: update(Stock)
+            .where(Stock.portfolio_id == portfolio_id, Stock.symbol == symbol)
+            .values(shares=shares, avg_price=avg_price, last_updated=datetime.utcnow())
+        )
+        return True
     
     def migrate_from_json(self, json_file="portfolios.json"):
         """Migrate data from JSON file to Supabase"""
@@ -296,16 +478,18 @@ class SupabaseManager:
                     for symbol, stock_data in portfolio_data.get('stocks', {}).items():
                         if 'last_updated' in stock_data:
                             del stock_data['last_updated']
-                    
-                    self.save_portfolio(portfolio_name, portfolio_data)
+                
+                # Insert every portfolio and stock in one transaction
+                if not self.save_portfolios_bulk(data):
+                    return False
                 
                 # Backup and remove the JSON file
                 os.rename(json_file, f"{json_file}.backup")
-                st.success("✅ Successfully migrated data from JSON to Supabase!")
+                _notify('success', "✅ Successfully migrated data from JSON to Supabase!")
                 return True
             
             return False
             
         except Exception as e:
-            st.error(f"Error migrating from JSON: {str(e)}")
+            _notify('error', f"Error migrating from JSON: {str(e)}")
             return False
\ No newline at end of file
@@ -0,0 +1,103 @@
+import tempfile
+import threading
+import time
+import unittest
+
+from yfinance.exceptions import YFRateLimitError
+
+import stock_data
+
+
+class GetOrFetchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.original_dir = stock_data.DISK_CACHE_DIR
+        stock_data.DISK_CACHE_DIR = self.tmpdir.name
+        self.manager = stock_data.StockDataManager()
+        self.calls = 0
+    
+    def tearDown(self):
+        self.manager.disk_cache.close()
+        stock_data.DISK_CACHE_DIR = self.original_dir
+        self.tmpdir.cleanup()
+    
+    def run_threads(self, count, fetch):
+        """Call _get_or_fetch for one key from count threads at once"""
+        barrier = threading.Barrier(count)
+        results = [None] * count
+        
+        def worker(i):
+            barrier.wait()
+            try:
+                results[i] = self.manager._get_or_fetch(self.manager.price_cache, "AAPL_price", fetch)
+            except Exception as e:
+                results[i] = e
+        
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def test_concurrent_callers_share_one_fetch(self):
+        def fetch():
+            self.calls += 1
+            time.sleep(0.2)
+            return 123.0
+        
+        results = self.run_threads(8, fetch)
+        
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [123.0] * 8)
+        self.assertEqual(self.manager.fetch_locks, {})
+    
+    def test_waiters_do_not_refetch_after_rate_limit(self):
+        def fetch():
+            self.calls += 1
+            time.sleep(0.2)
+            raise YFRateLimitError()
+        
+        results = self.run_threads(5, fetch)
+        
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sum(isinstance(result, YFRateLimitError) for result in results), 1)
+        self.assertEqual(results.count(None), 4)
+        self.assertIn("AAPL_price", self.manager.rate_limited)
+        self.assertEqual(self.manager.fetch_locks, {})
+    
+    def test_waiters_do_not_refetch_after_failure(self):
+        def fetch():
+            self.calls += 1
+            time.sleep(0.2)
+            raise ValueError("boom")
+        
+        results = self.run_threads(5, fetch)
+        
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results.count(None), 4)
+        self.assertIn("AAPL_price", self.manager.missing_cache)
+
+    
+    def test_empty_result_is_remembered_as_missing(self):
+        def fetch():
+            self.calls += 1
+            raise stock_data.NoDataError("No price data for AAPL")
+        
+        price_cache = self.manager.price_cache
+        self.assertIsNone(self.manager._get_or_fetch(price_cache, "AAPL_price", fetch))
+        self.assertIsNone(self.manager._get_or_fetch(price_cache, "AAPL_price", fetch))
+        self.assertEqual(self.calls, 1)
+        self.assertIn("AAPL_price", self.manager.missing_cache)
+
+    
+    def test_only_persisted_keys_reach_disk(self):
+        self.manager._get_or_fetch(self.manager.price_cache, "AAPL_price", lambda: 123.0)
+        self.manager._get_or_fetch(self.manager.data_cache, "AAPL_1y", lambda: "history", persist=True)
+        
+        self.assertNotIn("AAPL_price", self.manager.disk_cache)
+        self.assertEqual(self.manager.disk_cache.get("AAPL_1y"), "history")
+
+
+if __name__ == "__main__":
+    unittest.main()